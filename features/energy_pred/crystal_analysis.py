@@ -1,21 +1,107 @@
+import gzip
+import hashlib
+import os
 import re
 import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 from enum import Enum
+from functools import cached_property, lru_cache
+from importlib.metadata import version
+from itertools import chain
 from pathlib import Path
-from typing import List, Tuple, Optional, Dict, Callable
+from types import MappingProxyType
+from typing import List, Tuple, Optional, Dict, Callable, Mapping
 
+import duckdb
 import numpy as np
 import pandas as pd
 import sqlalchemy as sa
 import pickle
+from joblib import Parallel, delayed
+from numba import njit, prange
 
-from pymatgen.ext.matproj import MPRester
+from mp_api.client import MPRester
 from pymatgen.analysis.defects.generators import VacancyGenerator
 from pymatgen.analysis.local_env import CrystalNN
 from pymatgen.core import Species, Structure
 
 EB_DICT = {"filepath": "../../data/Eb.csv", "column_name": "Eb", "comparison": "os"}
 VR_DICT = {"filepath": "../../data/Vr.csv", "column_name": "Vr", "comparison": "n"}
+DB_FILEPATH = "../../transform/database.db"
+# Bump when the cached cn_dicts format or the analysis changes, to invalidate old entries
+CN_CACHE_VERSION = 1
+CN_CACHE_MAX_ENTRIES = 4096
+
+_PYMATGEN_VERSION = version("pymatgen")
+
+_INTEGER_SPECIES_RE = re.compile(r"^[A-Za-z]+\d+[+-]$")
+
+
+def _cn_cache_dir() -> Optional[Path]:
+
+    # DEFTPY_CN_CACHE_DIR relocates the CrystalNN cache; setting it to an empty string disables it
+    cache_dir = os.environ.get("DEFTPY_CN_CACHE_DIR")
+    if cache_dir is not None:
+        return Path(cache_dir) if cache_dir else None
+    return Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "deftpy" / "cn"
+
+
+@lru_cache(maxsize=1024)
+def _parse_species(species_string: str) -> Species:
+
+    return Species.from_string(species_string)
+
+
+@lru_cache(maxsize=None)
+def _load_table(filepath: str) -> pd.DataFrame:
+
+    # The CSVs are static, so parse each one once per process rather than once per Crystal
+    return pd.read_csv(Path(__file__).parent / filepath)
+
+
+def _build_lookup(filepath: str, column_name: str, comparison: str) -> Mapping[Tuple[str, float], float]:
+
+    # Keep the first match per (elem, comparison) pair, as the row-wise lookup did
+    dataframe = _load_table(filepath).drop_duplicates(subset=["elem", comparison], keep="first")
+    lookup = dict(zip(zip(dataframe["elem"], dataframe[comparison]), dataframe[column_name]))
+    # Read-only, since the tables are shared by every Crystal
+    return MappingProxyType(lookup)
+
+
+_EB = _build_lookup(**EB_DICT)
+_VR = _build_lookup(**VR_DICT)
+
+
+@njit(cache=True, parallel=True)
+def _weighted_sum(cn: np.ndarray, eb: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+
+    # Each site only has a handful of neighbors, so a plain loop beats per-site NumPy calls;
+    # sites are independent, so they are spread across cores
+    out = np.zeros(offsets.shape[0] - 1)
+    for k in prange(out.shape[0]):
+        s = 0.0
+        for i in range(offsets[k], offsets[k + 1]):
+            s += cn[i] * eb[i]
+        out[k] = s
+    return out
+
+
+@njit(cache=True, parallel=True)
+def _nanmax(vr: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+
+    out = np.full(offsets.shape[0] - 1, np.nan)
+    for k in prange(out.shape[0]):
+        for i in range(offsets[k], offsets[k + 1]):
+            if not np.isnan(vr[i]) and (np.isnan(out[k]) or vr[i] > out[k]):
+                out[k] = vr[i]
+    return out
+
+
+# Compile the kernels at import rather than on the first get_descriptors call
+_weighted_sum(np.zeros(1), np.zeros(1), np.array([0, 1], dtype=np.int64))
+_nanmax(np.zeros(1), np.array([0, 1], dtype=np.int64))
 
 
 class Crystal:
@@ -26,14 +112,15 @@ class Crystal:
         return re.split(r"(?=\d)", s, maxsplit=1)
 
     @staticmethod
-    def _parse_species_string(species_string: str) -> Tuple[Optional[Species], str, int]:
+    def _parse_species_string(species_string: str) -> Tuple[Optional[Species], str, float]:
 
-        # Check if the string is of valid format before trying to parse
-        if not re.match(r"[A-Za-z]+\d+\+", species_string):
+        # Integer charges can be split directly; fractional ones go through Species so the state stays exact
+        if _INTEGER_SPECIES_RE.match(species_string):
             split_str = Crystal._split_before_first_number(species_string)
-            return None, split_str[0], round(float(split_str[1][:-1]))
+            sign = -1 if split_str[1].endswith("-") else 1
+            return None, split_str[0], sign * int(split_str[1][:-1])
 
-        species = Species.from_string(species_string)
+        species = _parse_species(species_string)
         return species, species.symbol, species.oxi_state
 
     def __init__(
@@ -43,158 +130,268 @@ class Crystal:
             pymatgen_structure: Optional[Structure] = None,
             nn_finder: Optional[CrystalNN] = None,
             use_weights: Optional[bool] = False,
-            species_symbol: Optional[str] = "O"
+            species_symbol: Optional[str] = "O",
+            cif_string: Optional[str] = None
     ):
 
         if filepath:
             self.structure = Structure.from_file(filepath)
         elif poscar_string:
             self.structure = Structure.from_str(poscar_string, fmt="poscar")
+        elif cif_string:
+            self.structure = Structure.from_str(cif_string, fmt="cif")
         elif pymatgen_structure:
             self.structure = pymatgen_structure
         else:
-            raise ValueError("Specify either filepath, poscar_string, or pymatgen_structure.")
+            raise ValueError("Specify either filepath, poscar_string, cif_string, or pymatgen_structure.")
 
         self.nn_finder = nn_finder or CrystalNN()
         self.use_weights = use_weights
 
         self.species_symbol = species_symbol
 
-        package_dir = Path(__file__).parent
-        self.eb = pd.read_csv(package_dir / EB_DICT["filepath"])
-        self.vr = pd.read_csv(package_dir / VR_DICT["filepath"])
+        self._load_tables()
+
+    # The CrystalNN analysis is expensive, so it only runs when these are first accessed
+    @cached_property
+    def cn_dicts(self) -> List[Dict[str, int]]:
+
+        return self._initialize_structure_analysis()
+
+    @cached_property
+    def _all_values(self) -> Tuple[List[Dict[str, float]], List[Dict[str, float]]]:
+
+        return self._compute_all_values()
+
+    @cached_property
+    def bond_dissociation_enthalpies(self) -> List[Dict[str, float]]:
+
+        return self._all_values[0]
+
+    @cached_property
+    def reduction_potentials(self) -> List[Dict[str, float]]:
+
+        return self._all_values[1]
+
+    def _load_tables(self):
+
+        # Shared across all crystals and informational only; lookups go through _EB/_VR, so don't mutate these
+        self.eb = _load_table(EB_DICT["filepath"])
+        self.vr = _load_table(VR_DICT["filepath"])
+
+    def __getstate__(self):
+
+        # The Eb/Vr tables are static data, so reload them on unpickling instead of storing them per crystal
+        state = self.__dict__.copy()
+        for attr in ("eb", "vr"):
+            state.pop(attr, None)
+        return state
 
-        self._cn_dicts_initialized = False
-        self.cn_dicts = []
-        self.bond_dissociation_enthalpies = self._get_values(self.eb, EB_DICT["column_name"], EB_DICT["comparison"])
-        self.reduction_potentials = self._get_values(self.vr, VR_DICT["column_name"], VR_DICT["comparison"])
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self._load_tables()
 
     def _initialize_structure_analysis(self) -> List[Dict[str, int]]:
 
-        if self._cn_dicts_initialized:
-            return self.cn_dicts
+        # CrystalNN is deterministic for a given structure, so reuse results from earlier runs.
+        # The key is taken before oxidation states are guessed, so a hit skips that work too
+        cache_path = self._cn_cache_path()
+        if cache_path is not None:
+            try:
+                with open(cache_path, "rb") as file:
+                    return pickle.load(file)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                # Missing or unreadable entries are just a cache miss
+                pass
 
         # Check for oxidation states and add them if they are not present in the structure object already
-        if sum([x.oxi_state != 0 for x in self.structure.species]) == 0:
+        if not any(x.oxi_state != 0 for x in self.structure.species):
             self.structure.add_oxidation_state_by_guess()
+
         vacancy_generator = VacancyGenerator()
         vacancies = vacancy_generator.get_defects(self.structure)
         indices = [v.defect_site_index for v in vacancies if v.site.specie.symbol == self.species_symbol]
-        self.cn_dicts = [self.nn_finder.get_cn_dict(self.structure, i, use_weights=self.use_weights) for i in indices]
-        self._cn_dicts_initialized = True
-        return self.cn_dicts
+        # Sites are independent, but spawning workers only pays off for more than a few of them
+        if len(indices) < 4:
+            cn_dicts = [self.nn_finder.get_cn_dict(self.structure, i, use_weights=self.use_weights) for i in indices]
+        else:
+            cn_dicts = Parallel(n_jobs=-1, prefer="processes")(
+                delayed(self.nn_finder.get_cn_dict)(self.structure, i, use_weights=self.use_weights) for i in indices
+            )
 
-    def _get_values(self, dataframe: pd.DataFrame, column_name: str, comparison: str) -> List[Dict[str, float]]:
+        if cache_path is not None:
+            self._write_cn_cache(cache_path, cn_dicts)
+        return cn_dicts
+
+    @staticmethod
+    def _write_cn_cache(cache_path: Path, cn_dicts: List[Dict[str, int]]):
 
-        self._initialize_structure_analysis()
-        values = []
+        # Write to a temporary file and rename it into place, so readers never see a partial entry;
+        # failures (e.g. a read-only home directory) only mean the result isn't cached
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            file = tempfile.NamedTemporaryFile(dir=cache_path.parent, suffix=".tmp", delete=False)
+        except OSError:
+            return
+        try:
+            with file:
+                pickle.dump(cn_dicts, file)
+            os.replace(file.name, cache_path)
+        except OSError:
+            with suppress(OSError):
+                os.unlink(file.name)
+            return
+        Crystal._prune_cn_cache(cache_path.parent)
+
+    @staticmethod
+    def _prune_cn_cache(cache_dir: Path):
+
+        # Keep the cache bounded by dropping the least recently written entries
+        with suppress(OSError):
+            entries = list(cache_dir.glob("*.pkl"))
+            if len(entries) <= CN_CACHE_MAX_ENTRIES:
+                return
+            entries.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in entries[:len(entries) - CN_CACHE_MAX_ENTRIES]:
+                entry.unlink(missing_ok=True)
+
+    def _cn_cache_path(self) -> Optional[Path]:
+
+        cache_dir = _cn_cache_dir()
+        if cache_dir is None:
+            return None
+
+        # The key covers everything the cn_dicts depend on, not just the structure
+        finder_params = sorted(
+            (name, value) for name, value in vars(self.nn_finder).items()
+            if isinstance(value, (bool, int, float, str, tuple, type(None)))
+        )
+        key = hashlib.sha1()
+        key.update(f"{CN_CACHE_VERSION}|{_PYMATGEN_VERSION}|{type(self.nn_finder).__name__}|{finder_params}".encode())
+        species_strings = [site.species_string for site in self.structure]
+        key.update(f"{self.species_symbol}|{self.use_weights}|{species_strings}".encode())
+        key.update(np.round(self.structure.lattice.matrix, 8).tobytes())
+        key.update(np.round(self.structure.frac_coords, 8).tobytes())
+        return cache_dir / f"{key.hexdigest()}.pkl"
+
+    def _compute_all_values(self) -> Tuple[List[Dict[str, float]], List[Dict[str, float]]]:
+
+        # Parse each species once and look it up in both tables in the same pass
+        eb_values = []
+        vr_values = []
         for cn_dict in self.cn_dicts:
-            value = {}
+            eb_value = {}
+            vr_value = {}
             for species_string, cn in cn_dict.items():
-                species = Species.from_string(species_string)
-                symbol = species.symbol
-                oxidation_state = species.oxi_state
-                condition = (dataframe.elem == symbol) & (dataframe[comparison] == oxidation_state)
-                if not dataframe.loc[condition, column_name].empty:
-                    value[species_string] = dataframe.loc[condition, column_name].iloc[0]
-                else:
-                    value[species_string] = np.nan
-            values.append(value)
-        return values
+                _, symbol, oxidation_state = Crystal._parse_species_string(species_string)
+                key = (symbol, oxidation_state)
+                eb_value[species_string] = _EB.get(key, np.nan)
+                vr_value[species_string] = _VR.get(key, np.nan)
+            eb_values.append(eb_value)
+            vr_values.append(vr_value)
+        return eb_values, vr_values
 
     def to_pickle(self):
 
-        return pickle.dumps(self)
+        return gzip.compress(pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL), compresslevel=5)
 
     @staticmethod
     def from_pickle(pickle_data):
 
-        return pickle.loads(pickle_data)
+        return pickle.loads(gzip.decompress(pickle_data))
     
 
-def get_perovskite_structure(perovskite, API):
+def get_perovskite_structure(perovskite, API, mpr=None, save_poscar=False):
 
-    with MPRester(API) as mpr:
-        # Query for structures and band gap energies
-        results = mpr.query(criteria={"pretty_formula": perovskite},
-                            properties=["cif", "band_gap"])
+    # Reuse the caller's MPRester session when given, so batch runs share one HTTPS session
+    if mpr is None:
+        with MPRester(API) as mpr:
+            return get_perovskite_structure(perovskite, API, mpr=mpr, save_poscar=save_poscar)
 
-        if results:
-            # Assume the first result is the desired one
-            structure_cif = results[0]["cif"]
-            band_gap_energy = results[0]["band_gap"]
-            
-            # Optionally write the POSCAR file content to a file
-            with open(f"{perovskite}_POSCAR", "w") as file:
-                file.write(structure_cif)
-            
-            print(f"Band gap energy for {perovskite}: {band_gap_energy} eV")
+    # Query for structures and band gap energies, requesting only the fields we use
+    docs = mpr.summary.search(formula=perovskite, fields=["structure", "band_gap"])
 
-            crystal = Crystal(poscar_string=structure_cif)
-            
-            crystal.eg = band_gap_energy
+    if docs:
+        # Assume the first result is the desired one
+        structure = docs[0].structure
+        band_gap_energy = docs[0].band_gap
+        
+        # Optionally write the POSCAR file content to a file
+        if save_poscar:
+            structure.to(filename=f"{perovskite}_POSCAR", fmt="poscar")
+        
+        print(f"Band gap energy for {perovskite}: {band_gap_energy} eV")
 
-            crystal_pickle = crystal.to_pickle()
+        crystal = Crystal(pymatgen_structure=structure)
+        
+        crystal.eg = band_gap_energy
 
-            return crystal_pickle, band_gap_energy
-        else:
-            print(f"No results found for {perovskite}")
-            return None, None
+        crystal_pickle = crystal.to_pickle()
+
+        return crystal_pickle, band_gap_energy
+    else:
+        print(f"No results found for {perovskite}")
+        return None, None
+
+
+def initialize_crystals(perovskites, API, max_workers=4):
+
+    # Few workers: they share one MPRester session and the API is rate-limited
+    with MPRester(API) as mpr, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda p: get_perovskite_structure(p, API, mpr=mpr), perovskites))
+
+    return [
+        {"material_id": perovskite, "serialized_crystal": crystal_pickle, "band_gap": band_gap_energy}
+        for perovskite, (crystal_pickle, band_gap_energy) in zip(perovskites, results)
+    ]
         
 
 def get_descriptors(structure):
-    crystal = structure.from_pickle()
+    crystal = Crystal.from_pickle(structure)
 
-    CN = crystal.cn_dicts
     Eb = crystal.bond_dissociation_enthalpies
     Vr = crystal.reduction_potentials
 
-# Calculate CN-weighted Eb sum
-    Eb_sum = []
-    for CN_dict, Eb_dict in zip(CN, Eb):
-        CN_array = np.array(list(CN_dict.values()))
-        Eb_array = np.array(list(Eb_dict.values()))
-        Eb_sum.append(np.sum(CN_array * Eb_array))
+    # The per-site Eb_sum/Vr_max table comes from get_descriptors_batch
+    return (structure, Eb, Vr)
 
-    # Calculate maximum Vr
-    Vr_max = []
-    for Vr_dict in Vr:
-        try:
-            Vr_max.append(max(Vr_dict.values()))
-        except ValueError:
-            Vr_max.append(np.nan)
-
-    # Make a dataframe
-    df_ 
-    formula = df_defectid["formula"].values
-    defectid = df_defectid["defectid"].values
-    site = df_defectid["site"].values
-    Eg = df_defectid["bandgap_eV"].values
-    Ev = df_defectid["dH_eV"].values
-    try:
-        df_cf = pd.concat(
-            [
-                df_cf,
-                pd.DataFrame(
-                    {
-                        "formula": formula,
-                        "defectid": defectid,
-                        "site": site,
-                        "Eb_sum": Eb_sum,
-                        "Vr_max": Vr_max,
-                        "Eg": Eg,
-                        "Ev": Ev,
-                    }
-                ),
-            ]
-        )
-    except ValueError:
-        pass
-df_cf = df_cf.reset_index(drop=True)
 
+def get_descriptors_batch(structures):
+    crystals = [Crystal.from_pickle(structure) for structure in structures]
 
+    # Gather every site of every crystal so the kernels run once over the whole batch
+    CN = [CN_dict for crystal in crystals for CN_dict in crystal.cn_dicts]
+    Eb = [Eb_dict for crystal in crystals for Eb_dict in crystal.bond_dissociation_enthalpies]
+    Vr = [Vr_dict for crystal in crystals for Vr_dict in crystal.reduction_potentials]
+    n_sites = np.fromiter((len(crystal.cn_dicts) for crystal in crystals), dtype=np.int64, count=len(crystals))
 
-    return (structure, Eb, Vr)
+    # Flatten the per-site dicts into one array each, with offsets marking where each site starts
+    lengths = np.fromiter((len(CN_dict) for CN_dict in CN), dtype=np.int64, count=len(CN))
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    CN_array = np.fromiter(chain.from_iterable(d.values() for d in CN), dtype=np.float64, count=offsets[-1])
+    Eb_array = np.fromiter(chain.from_iterable(d.values() for d in Eb), dtype=np.float64, count=offsets[-1])
+    Vr_array = np.fromiter(chain.from_iterable(d.values() for d in Vr), dtype=np.float64, count=offsets[-1])
+
+    # Calculate CN-weighted Eb sum
+    Eb_sum = _weighted_sum(CN_array, Eb_array, offsets)
+
+    # Calculate maximum Vr
+    Vr_max = _nanmax(Vr_array, offsets)
+
+    # Make a dataframe, built once from whole columns rather than concatenated site by site
+    site_starts = np.concatenate(([0], np.cumsum(n_sites)))[:-1]
+    df_cf = pd.DataFrame(
+        {
+            "formula": np.repeat([crystal.structure.composition.reduced_formula for crystal in crystals], n_sites),
+            "defectid": np.arange(len(CN)) - np.repeat(site_starts, n_sites),
+            "Eb_sum": Eb_sum,
+            "Vr_max": Vr_max,
+            "Eg": np.repeat([getattr(crystal, "eg", np.nan) for crystal in crystals], n_sites),
+        }
+    )
+
+    return df_cf
 
 
 def compute_properties(serialized_crystals):
@@ -205,25 +402,45 @@ def apply_predictive_model(serialized_crystals):
     # Logic to unserialize, apply predictive model, and re-serialize
     pass
 
-def insert_into_db(dataframe, table_name):
-    # Logic to insert data into DuckDB
-    pass
+def insert_into_db(dataframe, table_name, con):
+    # Let DuckDB scan the DataFrame's columns directly instead of inserting row by row.
+    # The target is fully qualified, since a same-named temp table would otherwise shadow it
+    database = con.execute("SELECT current_database()").fetchone()[0]
+    target = f'"{database}".main."{table_name}"'
+    con.register("df_tmp", dataframe)
+    try:
+        con.execute(f"CREATE TABLE IF NOT EXISTS {target} AS SELECT * FROM df_tmp LIMIT 0")
+        con.execute(f"INSERT INTO {target} SELECT * FROM df_tmp")
+    finally:
+        con.unregister("df_tmp")
 
 def main():
     # Step 1: Initialization
     initial_data = initialize_crystals(perovskites, API)
     initial_df = pd.DataFrame(initial_data)
-    insert_into_db(initial_df, 'raw_perovskite_data')
 
     # Step 2: Analysis
     analyzed_data = compute_properties(initial_df['serialized_crystal'])
     analyzed_df = pd.DataFrame(analyzed_data)
-    insert_into_db(analyzed_df, 'ind_perovskite_data')
 
     # Step 3: Prediction
     predicted_data = apply_predictive_model(analyzed_df['serialized_crystal'])
     predicted_df = pd.DataFrame(predicted_data)
-    insert_into_db(predicted_df, 'energy_pred_model')
+
+    con = duckdb.connect(str(Path(__file__).parent / DB_FILEPATH))
+    try:
+        # Stage all three tables in one short transaction so DuckDB only flushes once, on commit
+        con.begin()
+        try:
+            insert_into_db(initial_df, 'raw_perovskite_data', con)
+            insert_into_db(analyzed_df, 'ind_perovskite_data', con)
+            insert_into_db(predicted_df, 'energy_pred_model', con)
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+    finally:
+        con.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,13 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor
 
 #Background
 @given('an API key is provided and a the user has perovskite identifiers')
 # This function will use the perovskite name(s) to access the POSCAR structure via API connection. 
 # It will then use this to construct an instance of class Crystal, which will be serialized and stored.
 def get_perovskite_structure(*perovskites, API):
-    structures = {}
-    for perovskite in perovskites:
-        structure = deftpy.get_data(perovskite, API)
-        structures[perovskite] = structure
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        structures = dict(executor.map(lambda p: (p, deftpy.get_data(p, API)), perovskites))
     return structures
 
 #Scenario 1